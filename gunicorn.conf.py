@@ -0,0 +1,32 @@
+# gunicorn.conf.py — production server settings for app.py
+#
+# Run with:
+#     gunicorn -c gunicorn.conf.py app:app
+#
+# Notes:
+# - One worker process owns the models (and the GPU); gthread threads handle concurrent
+#   uploads/JSON work and feed the in-process micro-batcher.
+# - preload_app stays off: the CUDA context and the micro-batcher threads created at
+#   import time do not survive fork(). For CPU-only scale-out, raise WEB_CONCURRENCY;
+#   each worker then loads its own copy of the models.
+
+import os
+
+# Same host/port as before, so the ngrok tunnel keeps working.
+bind = os.environ.get("BIND", "0.0.0.0:5000")
+
+workers = int(os.environ.get("WEB_CONCURRENCY", "1"))
+worker_class = "gthread"
+threads = int(os.environ.get("GUNICORN_THREADS", "8"))
+
+# The worker imports app.py (model download/load, torch.compile, allocator warmup,
+# warmup requests, optionally ONNX export + TensorRT engine build) inside load_wsgi(),
+# before it starts heartbeating. The arbiter kills any worker silent for longer than
+# `timeout`, so it must cover a cold start or the worker boot-loops. With gthread
+# workers the heartbeat keeps running while requests are in flight, so a long
+# timeout does not delay detection of slow requests. Override with GUNICORN_TIMEOUT.
+timeout = int(os.environ.get("GUNICORN_TIMEOUT", "1800"))
+graceful_timeout = 30
+keepalive = 5
+
+preload_app = False